@@ -0,0 +1,40 @@
+import os
+import tarfile
+import urllib.request
+from collections import defaultdict
+
+# Imagenette (10 easily classified ImageNet classes, 320px) validation split. Small enough to
+# download quickly, and real ImageNet photos so the INT8 activation ranges match what ResNet-50 sees
+IMAGENETTE_URL = "https://s3.amazonaws.com/fast-ai-imageclas/imagenette2-320.tgz"
+CALIBRATION_PER_CLASS = 10
+HELDOUT_PER_CLASS = 50
+
+CALIBRATION_DIR = "calibration"
+HELDOUT_DIR = "heldout"
+
+if __name__ == "__main__":
+    # Run from examples/resnet-50. Writes 100 calibration images and a separate 500 image held-out set,
+    # both for quantize.py. Neither is copied into the containers
+    for directory in [CALIBRATION_DIR, HELDOUT_DIR]:
+        os.makedirs(directory, exist_ok=True)
+
+    seen = defaultdict(int)
+    with urllib.request.urlopen(IMAGENETTE_URL) as response, tarfile.open(fileobj=response, mode="r|gz") as tar:
+        for member in tar:
+            # members look like imagenette2-320/val/n01440764/ILSVRC2012_val_00009111.JPEG
+            parts = member.name.split("/")
+            if not member.isfile() or len(parts) != 4 or parts[1] != "val":
+                continue
+            wnid, filename = parts[2], parts[3]
+            index = seen[wnid]
+            seen[wnid] += 1
+            if index >= CALIBRATION_PER_CLASS + HELDOUT_PER_CLASS:
+                continue
+
+            data = tar.extractfile(member).read()
+            directory = CALIBRATION_DIR if index < CALIBRATION_PER_CLASS else HELDOUT_DIR
+            with open(os.path.join(directory, f"{wnid}_{filename}"), "wb") as f:
+                f.write(data)
+
+    print(f"Wrote {CALIBRATION_PER_CLASS * len(seen)} calibration images to {CALIBRATION_DIR}")
+    print(f"Wrote {HELDOUT_PER_CLASS * len(seen)} held-out images to {HELDOUT_DIR}")
@@ -0,0 +1,101 @@
+import glob
+import os
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+import torch
+from transformers import ResNetForImageClassification
+import onnxruntime as ort
+from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+from onnxruntime.quantization.shape_inference import quant_pre_process
+
+# Calibrate with exactly the decode and transform the endpoint uses
+sys.path.insert(0, "generate-container")
+from sageturner import build_transform, read_image
+
+# Exports ResNet-50 to ONNX and statically quantizes it (QDQ) so ONNX Runtime can use the int8 VNNI
+# conv/matmul kernels on CPU, then checks the INT8 model against the FP32 one on images the quantizer
+# never saw. Run from examples/resnet-50 after fetch_calibration.py, before deploying. Writes
+# model.int8.onnx into both containers' code dirs, the servers only load it.
+# Needs torch 2.5+ for torch.onnx.export(kwargs=..., dynamo=...)
+CALIBRATION_DIR = "calibration"
+HELDOUT_DIR = "heldout"
+CONTAINER_DIRS = ["generate-container", "provided-container"]
+MIN_AGREEMENT = 0.98
+
+def image_paths(directory):
+    paths = sorted(
+        path for pattern in ("*.jpg", "*.jpeg", "*.JPEG", "*.png")
+        for path in glob.glob(os.path.join(directory, pattern))
+    )
+    if not paths:
+        sys.exit(f"No images found in {os.path.abspath(directory)}, run fetch_calibration.py first")
+    return paths
+
+class ResNetCalibrationReader(CalibrationDataReader):
+    # Feeds real, preprocessed images to the quantizer so the INT8 activation ranges match what
+    # the endpoint will actually see
+    def __init__(self, image_paths, transform):
+        self.inputs = iter(
+            {"pixel_values": transform(read_image(Path(path).read_bytes())).unsqueeze(0).numpy()}
+            for path in image_paths
+        )
+
+    def get_next(self):
+        return next(self.inputs, None)
+
+if __name__ == "__main__":
+    model = ResNetForImageClassification.from_pretrained(local_files_only=True, config="generate-container/config.json", pretrained_model_name_or_path="artefact")
+    model.eval()
+    transform = build_transform("generate-container/preprocessor_config.json")
+
+    # Static INT8 ranges are only as good as the images they're measured on, ~100 representative images are needed
+    calibration = image_paths(CALIBRATION_DIR)
+    if len(calibration) < 100:
+        print(f"Only {len(calibration)} calibration images found, INT8 accuracy may suffer. ~100 are recommended")
+
+    with tempfile.TemporaryDirectory() as export_dir:
+        torch.onnx.export(
+            model,
+            (torch.randn(1, 3, 224, 224),),
+            os.path.join(export_dir, "model.onnx"),
+            input_names=["pixel_values"],
+            output_names=["logits"],
+            dynamic_axes={"pixel_values": {0: "batch"}, "logits": {0: "batch"}},
+            opset_version=13,
+            do_constant_folding=True,
+            kwargs={"return_dict": False},
+            # dynamic_axes and opset 13 are TorchScript exporter options, newer torch defaults to the dynamo exporter
+            dynamo=False,
+        )
+        quant_pre_process(os.path.join(export_dir, "model.onnx"), os.path.join(export_dir, "model.pre.onnx"))
+        quantize_static(
+            os.path.join(export_dir, "model.pre.onnx"),
+            os.path.join(export_dir, "model.int8.onnx"),
+            calibration_data_reader=ResNetCalibrationReader(calibration, transform),
+            quant_format=QuantFormat.QDQ,
+            per_channel=True,
+            activation_type=QuantType.QInt8,
+            weight_type=QuantType.QInt8,
+        )
+        session = ort.InferenceSession(os.path.join(export_dir, "model.int8.onnx"), providers=["CPUExecutionProvider"])
+
+        heldout = image_paths(HELDOUT_DIR)
+        agree = 0
+        for path in heldout:
+            pixel_values = transform(read_image(Path(path).read_bytes())).unsqueeze(0)
+            int8_label = int(session.run(None, {"pixel_values": pixel_values.numpy()})[0].argmax(-1)[0])
+            with torch.inference_mode():
+                fp32_label = int(model(pixel_values).logits.argmax(-1)[0])
+            agree += int8_label == fp32_label
+
+        agreement = agree / len(heldout)
+        print(f"INT8 top-1 matches FP32 on {agree}/{len(heldout)} held-out images ({agreement:.1%})")
+        if agreement < MIN_AGREEMENT:
+            sys.exit(f"Agreement is below {MIN_AGREEMENT:.0%}, check the calibration set. model.int8.onnx was not written")
+
+        for directory in CONTAINER_DIRS:
+            shutil.copy(os.path.join(export_dir, "model.int8.onnx"), directory)
+    print(f"Wrote model.int8.onnx to {', '.join(CONTAINER_DIRS)}")
@@ -241,8 +241,8 @@ fn cpu_dockerfile() -> String {
     # Install extra system packages
     RUN if [ "${EXTRA_SYSTEM_PACKAGES}" != "" ]; then apt-get -y install --no-install-recommends ${EXTRA_SYSTEM_PACKAGES}; fi
 
-    # Install FastAPI as standard 
-    RUN pip install fastapi[standard]
+    # Install FastAPI as standard, plus orjson for the generated server's request/response JSON
+    RUN pip install fastapi[standard] orjson
 
     # Install extra python packages 
     RUN if [ "${EXTRA_PYTHON_PACKAGES}" != "" ]; then pip3 install --no-input ${EXTRA_PYTHON_PACKAGES}; fi
@@ -291,8 +291,8 @@ fn gpu_dockerfile() -> String {
     # Install extra system packages
     RUN if [ "${EXTRA_SYSTEM_PACKAGES}" != "" ]; then apt-get -y install --no-install-recommends ${EXTRA_SYSTEM_PACKAGES}; fi
 
-    # Install FastAPI as standard 
-    RUN pip install fastapi[standard]
+    # Install FastAPI as standard, plus orjson for the generated server's request/response JSON
+    RUN pip install fastapi[standard] orjson
 
     # Install extra python packages 
     RUN if [ "${EXTRA_PYTHON_PACKAGES}" != "" ]; then pip install --no-input ${EXTRA_PYTHON_PACKAGES}; fi
@@ -300,6 +300,8 @@ fn gpu_dockerfile() -> String {
     ENV PYTHONUNBUFFERED=TRUE
     ENV PYTHONDONTWRITEBYTECODE=TRUE
     ENV PATH="${PATH}:/opt/program"
+    # One CUDA context per GPU, so the generated server runs a single worker
+    ENV SAGETURNER_WORKERS=1
 
     COPY . /opt/program
     COPY serve.py /opt/program
@@ -4,9 +4,23 @@ pub fn get_serve_code() -> String {
     
     let serve_code = r#"import sageturner
 from fastapi import FastAPI, Request, Response, status, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse
+import orjson
+from contextlib import asynccontextmanager
+import os
 import uvicorn
-model = sageturner.load()
-app = FastAPI()
+# One worker per two cores unless the Dockerfile says otherwise (GPU images run a single worker).
+# Inferentia instances also run one, every worker would otherwise compile its own copy for the NeuronCores
+NEURON = os.path.exists("/dev/neuron0")
+WORKERS = int(os.environ.get("SAGETURNER_WORKERS", 1 if NEURON else max(1, os.cpu_count() // 2)))
+model = None
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global model
+    model = sageturner.load()
+    yield
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 @app.get('/ping')
 async def ping():
     if model: 
@@ -15,13 +29,18 @@ async def ping():
         raise HTTPException(status_code=500, detail="Error")
 @app.post('/invocations')
 async def predict(request: Request):
-    body = await request.json()
-    response = sageturner.predict(model, body)
-    return response
+    if request.headers.get("content-type", "").lower().startswith(("image/", "application/x-image")):
+        body = {"image_bytes": await request.body()}
+    else:
+        body = orjson.loads(await request.body())
+    response = await run_in_threadpool(sageturner.predict, model, body)
+    # Returned as an ORJSONResponse to skip FastAPI's jsonable_encoder, so numpy arrays serialize natively.
+    # predict must return what orjson can serialize, see the README
+    return ORJSONResponse(response)
 if __name__ == "__main__":
-    config = uvicorn.Config("serve:app", port=8080, host="0.0.0.0")
-    server = uvicorn.Server(config=config)
-    server.run()"#.to_string();
+    # Workers inherit the environment, so load() can read the real worker count to size its thread pools
+    os.environ["SAGETURNER_WORKERS"] = str(WORKERS)
+    uvicorn.run("serve:app", port=8080, host="0.0.0.0", loop="uvloop", http="httptools", workers=WORKERS)"#.to_string();
 
            println!("Serve code: ");
            print!("{serve_code}");